@@ -1,6 +1,12 @@
 from threading import Thread
-import urllib2
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
 import os
+import io
+import errno
+import select
+import socket
 import datetime
 import json
 import time
@@ -18,6 +24,12 @@ except ImportError:
     _use_scapy = False
 
 
+# A single HTTP session is shared by all devices, so connections to ethoscopes are kept alive between refreshes.
+# We keep a connection pool for up to 64 devices, and a few connections per device.
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=64, pool_maxsize=4))
+
+
 class ScanException(Exception):
     pass
 
@@ -48,6 +60,11 @@ def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
 class DeviceScanner(Thread):
     _refresh_period = 1.0
     _filter_device_period = 5
+    # at most this many devices are queried at the same time
+    _max_concurrent_refreshes = 64
+    _device_port = 9000
+    # how long we wait for devices to accept a connection when looking for live ips
+    _port_scan_timeout = 1.0
 
     def __init__(self, local_ip = "192.169.123.1", ip_range = (6,100),device_refresh_period = 5, results_dir="/ethoscope_results"):
         self._is_active = True
@@ -60,9 +77,15 @@ class DeviceScanner(Thread):
         self._use_scapy = _use_scapy
 
         for ip in self._subnet_ips(local_ip, (6,254)):
-            d =  Device(ip, device_refresh_period, results_dir=results_dir)
-            d.start()
+            d =  Device(ip, device_refresh_period, port=self._device_port, results_dir=results_dir)
             self._devices.append(d)
+
+        # devices are refreshed by a shared pool of workers rather than by one long-lived thread each
+        self._pool = ThreadPoolExecutor(max_workers=min(len(self._devices), self._max_concurrent_refreshes))
+        # "device" -> future of its pending refresh
+        self._pending_refreshes = {}
+        # (version, "id" -> "info"), replaced after every scanning pass
+        self._devices_info_snapshot = (0, {})
         super(DeviceScanner, self).__init__()
 
     def _available_ips(self, local_ip, ip_range):
@@ -70,15 +93,50 @@ class DeviceScanner(Thread):
             for c in self._arp_alive(local_ip):
                 yield c
         else:
-            for c in self._subnet_ips(local_ip, ip_range):
+            for c in self._port_alive(local_ip, ip_range):
                 yield c
 
     def _subnet_ips(self,local_ip, ip_range):
+        subnet_ip = ".".join(local_ip.split(".")[0:3])
         for i in range(ip_range[0], ip_range[1] + 1):
-            subnet_ip = local_ip.split(".")[0:3]
-            subnet_ip = ".".join(subnet_ip)
             yield "%s.%i" % (subnet_ip, i)
 
+    def _port_alive(self, local_ip, ip_range):
+        """
+        Opens non-blocking connections to the device port of every ip in the range and
+        returns the ips that accept it, so that only those are queried over HTTP.
+        """
+        sockets = {}
+        alive = []
+        try:
+            for ip in self._subnet_ips(local_ip, ip_range):
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setblocking(0)
+                sockets[s] = ip
+                err = s.connect_ex((ip, self._device_port))
+                if err == 0:
+                    alive.append(ip)
+                elif err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    # e.g. connection refused: nothing listens on this ip
+                    s.close()
+                    del sockets[s]
+
+            pending = [s for s, ip in sockets.items() if ip not in alive]
+            deadline = time.time() + self._port_scan_timeout
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                _, writable, _ = select.select([], pending, [], remaining)
+                for s in writable:
+                    pending.remove(s)
+                    if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        alive.append(sockets[s])
+        finally:
+            for s in sockets:
+                s.close()
+        return alive
+
     def _arp_alive(self, local_ip):
 
         try:
@@ -105,7 +163,7 @@ class DeviceScanner(Thread):
 
         except Exception as e:
             logging.error("Cannot use scapy. Defaulting to subnet")
-            logging.error(traceback.format_exc(e))
+            logging.error(traceback.format_exc())
             self._use_scapy = False
             return []
 
@@ -120,58 +178,90 @@ class DeviceScanner(Thread):
         except KeyError:
             return
         except Exception as e:
-            logging.error(traceback.format_exc(e))
+            logging.error(traceback.format_exc())
             return
 
     def run(self):
         last_device_filter_time = 0
-        valid_ips = [ip for ip in self._available_ips(self._local_ip, self._ip_range)]
+        valid_ips = set()
 
         while self._is_active :
             if time.time() - last_device_filter_time > self._filter_device_period:
-                valid_ips = [ip for ip in self._available_ips(self._local_ip, self._ip_range)]
+                valid_ips = set(self._available_ips(self._local_ip, self._ip_range))
                 last_device_filter_time = time.time()
             for d in self._devices:
                 if d.ip() in valid_ips:
                     d.skip_scanning(False)
                 else:
                     d.skip_scanning(True)
-            for d in self._devices:
-                id = d.id()
-
-                if id and  (id not in self._device_id_map.keys()):
-                    logging.info("New device detected with id = %s" % id)
-                    self._device_id_map[id]= {}
-                    self._device_id_map[id]["dev"] = d
-                    self._device_id_map[id]["info"] = d.info().copy()
 
-            # can we find a device fo this each id
-            detected_ids = [d.id() for d in self._devices if d.id()]
-            for id in self._device_id_map.keys():
+            self._refresh_devices()
 
-                status = self._device_id_map[id]["info"]["status"]
+            detected_devices = {}
+            for d in self._devices:
+                id = d.id()
+                if id:
+                    detected_devices[id] = d
+
+            # the map is rebuilt and replaced at once, so that readers never see it partially updated
+            device_id_map = {}
+            now = time.time()
+            for id, entry in self._device_id_map.items():
+                if id in detected_devices:
+                    continue
+                info = entry["info"].copy()
                 # this default time is now. if device get out of use, their time is not updated
-                if status != "not_in_use":
-                    self._device_id_map[id]["info"]["time"] = time.time()
-                self._device_id_map[id]["dev"] = None
+                if info["status"] != "not_in_use":
+                    info["time"] = now
                 # special status for devices that are not detected anymore
-                self._device_id_map[id]["info"]["status"] = "not_in_use"
+                info["status"] = "not_in_use"
+                device_id_map[id] = {"dev": None, "info": info}
+
+            for id, d in detected_devices.items():
+                if id not in self._device_id_map:
+                    logging.info("New device detected with id = %s" % id)
+                info = d.info().copy()
+                info["time_since_backup"] = self._get_last_backup_time(d)
+                device_id_map[id] = {"dev": d, "info": info}
 
-                for d in self._devices:
-                    if d.id() == id and d.id() in detected_ids:
-                        self._device_id_map[id] = {}
-                        self._device_id_map[id]["dev"] = d
-                        self._device_id_map[id]["info"] = d.info().copy()
-                        self._device_id_map[id]["info"]["time_since_backup"] = self._get_last_backup_time(d)
-                        continue
+            self._device_id_map = device_id_map
+            devices_info = dict((id, entry["info"]) for id, entry in device_id_map.items())
+            self._devices_info_snapshot = (self._devices_info_snapshot[0] + 1, devices_info)
 
             time.sleep(self._refresh_period)
 
+    def _refresh_devices(self):
+        for d in self._devices:
+            if not self._is_active:
+                return
+            pending = self._pending_refreshes.get(d)
+            if pending is not None and not pending.done():
+                continue
+            if d.needs_refresh():
+                future = self._pool.submit(d.refresh)
+                future.add_done_callback(self._log_refresh_error)
+                self._pending_refreshes[d] = future
+
+    @staticmethod
+    def _log_refresh_error(future):
+        e = future.exception()
+        if e is not None:
+            logging.error("Could not refresh device: %s" % repr(e))
+
+    def devices_info_snapshot(self):
+        """
+        The information of all devices, as built by the last scanning pass, along with its version.
+        The version is incremented after every pass, as device information carries timestamps that change each time.
+        The returned map is shared and must not be modified.
+
+        :return: (version, a dict mapping device ids to device information)
+        :rtype: (int, dict)
+        """
+        return self._devices_info_snapshot
+
     def get_all_devices_info(self):
-        out = {}
-        for k, v in self._device_id_map.items():
-            out[k] =  v["info"]
-        return out
+        _, devices_info = self._devices_info_snapshot
+        return dict(devices_info)
 
     def get_device(self, id):
         try:
@@ -181,11 +271,13 @@ class DeviceScanner(Thread):
 
 
     def stop(self):
-        for d in self._devices:
-            d.stop()
         self._is_active = False
+        # the scanning loop must be over before the pool stops accepting refreshes
+        if self.is_alive():
+            self.join()
+        self._pool.shutdown(wait=False)
 
-class Device(Thread):
+class Device(object):
     _ethoscope_db_credentials = {"user": "ethoscope",
                                 "passwd": "ethoscope",
                                 "db":"ethoscope_db"}
@@ -204,29 +296,28 @@ class Device(Thread):
         self._results_dir = results_dir
         self._ip = ip
         self._port = port
-        self._id_url = "http://%s:%i/%s" % (ip, port, self._id_page)
+        self._base_url = "http://%s:%i" % (ip, port)
+        self._id_url = "%s/%s" % (self._base_url, self._id_page)
         self._reset_info()
 
-        self._is_active = True
         self._skip_scanning = False
         self._refresh_period = refresh_period
+        self._last_refresh = 0
 
-        super(Device,self).__init__()
-
-    def run(self):
-        last_refresh = 0
-        while self._is_active:
-            time.sleep(.2)
-            if time.time() - last_refresh > self._refresh_period:
+    def needs_refresh(self):
+        return time.time() - self._last_refresh > self._refresh_period
 
-                if not self._skip_scanning:
-                    self._update_info()
-                else:
-                    self._reset_info()
-                last_refresh = time.time()
+    def refresh(self):
+        try:
+            if not self._skip_scanning:
+                self._update_info()
+            else:
+                self._reset_info()
+        finally:
+            self._last_refresh = time.time()
 
     def send_instruction(self,instruction,post_data):
-        post_url = "http://%s:%i/%s/%s/%s" % (self._ip, self._port, self._controls_page,self._id, instruction)
+        post_url = "%s/%s/%s/%s" % (self._base_url, self._controls_page, self._id, instruction)
         self._check_instructions_status(instruction)
 
         # we do not expect any data back when device is powered off.
@@ -263,7 +354,7 @@ class Device(Thread):
         self._skip_scanning = value
 
     def user_options(self):
-        user_options_url= "http://%s:%i/%s/%s" % (self._ip, self._port, self._user_options_page, self._id)
+        user_options_url= "%s/%s/%s" % (self._base_url, self._user_options_page, self._id)
         out = self._get_json(user_options_url)
         return out
 
@@ -276,10 +367,12 @@ class Device(Thread):
         except KeyError:
             raise KeyError("Cannot find last image for device %s" % self._id)
 
-        img_url = "http://%s:%i/%s/%s" % (self._ip, self._port, self._static_page, img_path)
+        img_url = "%s/%s/%s" % (self._base_url, self._static_page, img_path)
         try:
-            return urllib2.urlopen(img_url,timeout=5)
-        except  urllib2.HTTPError:
+            resp = _session.get(img_url, timeout=5)
+            resp.raise_for_status()
+            return io.BytesIO(resp.content)
+        except requests.HTTPError:
             logging.error("Could not get image for ip = %s (id = %s)" % (self._ip, self._id))
             raise Exception("Could not get image for ip = %s (id = %s)" % (self._ip, self._id))
 
@@ -289,12 +382,13 @@ class Device(Thread):
         except KeyError:
             raise KeyError("Cannot find dbg img path for device %s" % self._id)
 
-        img_url = "http://%s:%i/%s/%s" % (self._ip, self._port, self._static_page, img_path)
+        img_url = "%s/%s/%s" % (self._base_url, self._static_page, img_path)
         try:
-            file_like = urllib2.urlopen(img_url)
-            return file_like
-        except Exception as e:
-            logging.warning(traceback.format_exc(e))
+            resp = _session.get(img_url, timeout=5)
+            resp.raise_for_status()
+            return io.BytesIO(resp.content)
+        except requests.RequestException:
+            logging.warning(traceback.format_exc())
 
 
 
@@ -303,9 +397,10 @@ class Device(Thread):
     def _get_json(self, url,timeout=5, post_data=None):
 
         try:
-            req = urllib2.Request(url, data=post_data, headers={'Content-Type': 'application/json'})
-            f = urllib2.urlopen(req, timeout=timeout)
-            message = f.read()
+            method = "GET" if post_data is None else "POST"
+            f = _session.request(method, url, data=post_data, headers={'Content-Type': 'application/json'}, timeout=timeout)
+            f.raise_for_status()
+            message = f.content
             if not message:
                 # logging.error("URL error whist scanning url: %s. No message back." % self._id_url)
                 raise ScanException("No message back")
@@ -315,10 +410,8 @@ class Device(Thread):
             except ValueError:
                 # logging.error("Could not parse response from %s as JSON object" % self._id_url)
                 raise ScanException("Could not parse Json object")
-        except urllib2.URLError as e:
+        except (requests.RequestException, socket.error) as e:
             raise ScanException(str(e))
-        except Exception as e:
-            raise ScanException("Unexpected error" + str(e))
 
 
     def _update_id(self):
@@ -349,7 +442,7 @@ class Device(Thread):
             self._reset_info()
             return
         try:
-            data_url = "http://%s:%i/data/%s" % (self._ip, self._port, self._id)
+            data_url = "%s/data/%s" % (self._base_url, self._id)
             resp = self._get_json(data_url)
             self._info.update(resp)
             resp = self._make_backup_path()
@@ -387,10 +480,7 @@ class Device(Thread):
 
         except Exception as e:
             logging.error("Could not generate backup path for device. Probably a MySQL issue")
-            logging.error(traceback.format_exc(e))
+            logging.error(traceback.format_exc())
             return {"backup_path": "None"}
 
         return {"backup_path": output_db_file}
-
-    def stop(self):
-        self._is_active = False
@@ -1,6 +1,20 @@
+# With `--gevent`, sockets, threads and sleeps are made cooperative, so device queries and HTTP requests
+# run as greenlets on a single OS thread. Patching has to happen before any other import,
+# so this option is looked up before the command line is parsed.
+import sys
+_use_gevent = "--gevent" in sys.argv[1:]
+if _use_gevent:
+    from gevent import monkey
+    monkey.patch_all()
+
 from bottle import *
 import subprocess
 import socket
+try:
+    # ujson serialises the device map several times faster than the standard library
+    import ujson as json
+except ImportError:
+    import json
 import logging
 import traceback
 from ethoscope_node.utils.helpers import  get_local_ip, get_internet_ip
@@ -24,8 +38,8 @@ def error_decorator(func):
         try:
             return func(*args, **kwargs)
         except Exception as e:
-            logging.error(traceback.format_exc(e))
-            return {'error': traceback.format_exc(e)}
+            logging.error(traceback.format_exc())
+            return {'error': traceback.format_exc()}
     return func_wrapper
 
 @app.route('/static/<filepath:path>')
@@ -66,15 +80,30 @@ def get_favicon():
     return server_static(STATIC_DIR+'/img/favicon.ico')
 
 
+# (scanner version, serialised device map). Rebound as a whole so concurrent requests never see a mismatched pair.
+# The scanner makes a new version every pass, so this only saves work when several clients poll within the same pass.
+_devices_json_cache = (None, None)
+
+def devices_json():
+    global _devices_json_cache
+    version, devices_info = device_scanner.devices_info_snapshot()
+    cached_version, payload = _devices_json_cache
+    if cached_version != version:
+        payload = json.dumps(devices_info)
+        _devices_json_cache = (version, payload)
+    return payload
+
 @app.get('/devices')
 @error_decorator
 def devices():
-    return device_scanner.get_all_devices_info()
+    response.content_type = 'application/json'
+    return devices_json()
 
 
 @app.get('/devices_list')
+@error_decorator
 def get_devices_list():
-    devices()
+    return devices()
 
 #Get the information of one device
 @app.get('/device/<id>/data')
@@ -212,18 +241,16 @@ def download(what):
 @error_decorator
 def node_info(req):#, device):
     if req == 'info':
-        df = subprocess.Popen(['df', RESULTS_DIR, '-h'], stdout=subprocess.PIPE)
+        df = subprocess.Popen(['df', RESULTS_DIR, '-h'], stdout=subprocess.PIPE, universal_newlines=True)
         disk_free = df.communicate()[0]
         disk_usage = RESULTS_DIR+" Not Found on disk"
         ip = "No IP assigned, check cable"
         MAC_addr = "Not detected"
+        WWW_MAC_addr = MAC_addr
         local_ip = ""
         try:
             disk_usage = disk_free.split("\n")[1].split()
-            net_info = subprocess.Popen(['ip','a'], stdout=subprocess.PIPE)
-            net_info = net_info.communicate()[0].split("\n")
-            WWW_MAC_addr = net_info[net_info.index([s for s in net_info if WWW_IP in s][0])-1].split("\t")[1].split(" ")[2]
-            LOCAL_MAC_addr = net_info[net_info.index([s for s in net_info if LOCAL_IP in s][0])-1].split("\t")[1].split(" ")[2]
+            WWW_MAC_addr = get_mac_address(WWW_IP)
         except Exception as e:
             logging.error(e)
         #fixme
@@ -240,6 +267,23 @@ def node_info(req):#, device):
     else:
         raise NotImplementedError()
 
+# ip -> MAC address. Interfaces do not change while the node is running,
+# so we only fork `ip a` once per address, whether the lookup succeeds or not.
+_mac_addresses = {}
+
+def get_mac_address(ip):
+    if ip is None:
+        return "Not detected"
+    if ip not in _mac_addresses:
+        try:
+            net_info = subprocess.Popen(['ip','a'], stdout=subprocess.PIPE, universal_newlines=True)
+            net_info = net_info.communicate()[0].split("\n")
+            _mac_addresses[ip] = net_info[net_info.index([s for s in net_info if ip in s][0])-1].split("\t")[1].split(" ")[2]
+        except (OSError, IndexError) as e:
+            logging.error("Could not find MAC address for ip %s: %s" % (ip, e))
+            _mac_addresses[ip] = "Not detected"
+    return _mac_addresses[ip]
+
 @app.post('/node-actions')
 @error_decorator
 def node_actions():
@@ -281,14 +325,12 @@ def redirection_to_home(id):
 
 @app.get('/device/<id>/ip')
 @error_decorator
-def redirection_to_home(id):
-    raise NotImplementedError
-    #
-    # dev_list = device_scanner.get_device_list()
-    # for id, data  in dev_list.items():
-    #     if id == id:
-    #         return data["ip"]
-    # return "None"
+def get_device_ip(id):
+    device = device_scanner.get_device(id)
+    # devices that are not detected anymore have no ip
+    if not device:
+        return "None"
+    return device.ip()
 
 
 @app.get('/more/<action>')
@@ -331,6 +373,7 @@ if __name__ == '__main__':
     parser.add_option("-l", "--local", dest="local", default=False, help="Run on localhost (run a node and device on the same machine, for development)", action="store_true")
     parser.add_option("-e", "--results-dir", dest="results_dir", default="/ethoscope_results",help="Where temporary result files are stored")
     parser.add_option("-r", "--subnet-ip", dest="subnet_ip", default="192.169.123.0", help="the ip of the router in your setup")
+    parser.add_option("--gevent", dest="gevent", default=False, help="Serve and scan devices with gevent greenlets. MySQL queries to devices are not cooperative and block the whole server while they run", action="store_true")
 
 
 
@@ -347,7 +390,7 @@ if __name__ == '__main__':
         WWW_IP = get_internet_ip()
     except Exception as e:
         logging.warning("Could not access internet!")
-        logging.warning(traceback.format_exc(e))
+        logging.warning(traceback.format_exc())
         WWW_IP = None
 
     tmp_imgs_dir = tempfile.mkdtemp(prefix="ethoscope_node_imgs")
@@ -356,28 +399,31 @@ if __name__ == '__main__':
         device_scanner = DeviceScanner(LOCAL_IP, results_dir=RESULTS_DIR)
         #device_scanner = DeviceScanner( results_dir=RESULTS_DIR)
         device_scanner.start()
-        #######TO be remove when bottle changes to version 0.13
-        server = "cherrypy"
-        try:
-            from cherrypy import wsgiserver
-        except:
-            #Trick bottle to think that cheroot is actulay cherrypy server adds the pacth to BOTTLE
-            server_names["cherrypy"]=CherootServer(host='0.0.0.0', port=PORT)
-            logging.warning("Cherrypy version is bigger than 9, we have to change to cheroot server")
-            pass
-        #########
-        run(app, host='0.0.0.0', port=PORT, debug=DEBUG, server='cherrypy')
+        if _use_gevent:
+            server = "gevent"
+        else:
+            #######TO be remove when bottle changes to version 0.13
+            server = "cherrypy"
+            try:
+                from cherrypy import wsgiserver
+            except ImportError:
+                #Trick bottle to think that cheroot is actulay cherrypy server adds the pacth to BOTTLE
+                server_names["cherrypy"]=CherootServer(host='0.0.0.0', port=PORT)
+                logging.warning("Cherrypy version is bigger than 9, we have to change to cheroot server")
+                pass
+            #########
+        run(app, host='0.0.0.0', port=PORT, debug=DEBUG, server=server)
 
     except KeyboardInterrupt:
         logging.info("Stopping server cleanly")
         pass
 
     except socket.error as e:
-        logging.error(traceback.format_exc(e))
+        logging.error(traceback.format_exc())
         logging.error("Port %i is probably not accessible for you. Maybe use another one e.g.`-p 8000`" % PORT)
 
     except Exception as e:
-        logging.error(traceback.format_exc(e))
+        logging.error(traceback.format_exc())
         close(1)
     finally:
         device_scanner.stop()
@@ -0,0 +1,64 @@
+"""
+Profiles one discovery pass of the node's DeviceScanner (port sweep + refresh of live devices),
+to check whether discovery is waiting on the network or spending time in python code.
+
+The pass runs sequentially in the main thread, so cProfile sees all of it.
+
+    python profile_scan.py -r 192.169.123.0 -o scan.prof
+
+If most of the time is spent waiting (select/recv/connect...), making discovery more concurrent is what helps.
+If parsing device responses (json) ever becomes a significant part of it, a faster parser is worth it.
+"""
+import cProfile
+import pstats
+import optparse
+import logging
+import time
+import re
+from ethoscope_node.utils.device_scanner import DeviceScanner
+
+# builtin calls during which the process is just waiting for the network
+_WAITING_CALLS = re.compile(r"\b(select|poll|recv|recv_into|connect|connect_ex|sendall|getaddrinfo)\b")
+
+
+def discovery_pass(scanner, local_ip, ip_range):
+    live_ips = scanner._port_alive(local_ip, ip_range)
+    for d in scanner._devices:
+        if d.ip() in live_ips:
+            d.refresh()
+    return live_ips
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    parser = optparse.OptionParser()
+    parser.add_option("-r", "--subnet-ip", dest="subnet_ip", default="192.169.123.0", help="the ip of the router in your setup")
+    parser.add_option("-n", "--last-ip", dest="last_ip", default=254, type="int", help="the last address of the subnet to scan")
+    parser.add_option("-o", "--output", dest="output", default="scan.prof", help="where to save the raw profile")
+    (options, args) = parser.parse_args()
+
+    ip_range = (6, options.last_ip)
+    # built outside of the profiler, so that only the sweep and the refreshes are measured
+    scanner = DeviceScanner(options.subnet_ip, ip_range=ip_range)
+
+    profiler = cProfile.Profile()
+    t0 = time.time()
+    live_ips = profiler.runcall(discovery_pass, scanner, options.subnet_ip, ip_range)
+    wall_time = time.time() - t0
+    profiler.dump_stats(options.output)
+
+    stats = pstats.Stats(profiler)
+    waiting_time = 0
+    json_time = 0
+    for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        # builtins are reported with a "~" file name
+        if filename == "~" and _WAITING_CALLS.search(name):
+            waiting_time += tt
+        # `loads` calls the decoder, so its cumulative time already includes it
+        if "json" in filename and name == "loads":
+            json_time += ct
+
+    print("%i live device(s) in %.3fs" % (len(live_ips), wall_time))
+    print("waiting on network: %.1f%%" % (100 * waiting_time / stats.total_tt))
+    print("parsing json: %.1f%%" % (100 * json_time / stats.total_tt))
+    stats.sort_stats("tottime").print_stats(15)
@@ -64,11 +64,12 @@ class TrackingUnit(object):
         if not absolute:
             return last_positions
         out =[]
+        offset = self._roi.offset
         for last_pos in last_positions:
             tmp_out = []
             for k,i in last_pos.items():
                 if isinstance(i, BaseRelativeVariable):
-                    tmp_out.append(i.to_absolute(self.roi))
+                    tmp_out.append(i.to_absolute_from_offset(offset))
                 else:
                     tmp_out.append(i)
             tmp_out = DataPoint(tmp_out)
@@ -1,7 +1,42 @@
 __author__ = 'quentin'
 
 
-class BaseIntVariable(int):
+def _not_implemented_new(message):
+    def __new__(cls, value):
+        raise NotImplementedError(message)
+    return staticmethod(__new__)
+
+
+class _VariableMeta(type):
+    """
+    Metaclass checking, once at class creation, that a variable type defines the required attributes.
+    Incomplete (i.e. abstract) types cannot be instantiated, whilst complete ones are built by `int.__new__` directly,
+    so that no check is performed each time a variable is instantiated.
+    """
+    def __init__(cls, name, bases, dct):
+        super(_VariableMeta, cls).__init__(name, bases, dct)
+        if getattr(cls, "functional_type", None) is None:
+            message = "Variables must have a functional data type such as 'distance', 'angle', 'bool', 'confidence'"
+        elif getattr(cls, "sql_data_type", None) is None:
+            message = "Variables must have an SQL data type such as INT"
+        elif getattr(cls, "header_name", None) is None:
+            message = "Variables must have a header name"
+        else:
+            message = None
+
+        if "__new__" in dct:
+            return
+        if message is None:
+            cls.__new__ = staticmethod(int.__new__)
+        else:
+            cls.__new__ = _not_implemented_new(message)
+
+
+# Instantiating the metaclass directly works with both python 2 and 3 metaclass syntaxes
+_MetaVariable = _VariableMeta("_MetaVariable", (int,), {})
+
+
+class BaseIntVariable(_MetaVariable):
     """
     Template class for defining arbitrary variable types.
     Each class derived from this one should at least define the three following attributes:
@@ -15,15 +50,6 @@ class BaseIntVariable(int):
     header_name = None
     functional_type = None # {distance, angle, bool, confidence,...}
 
-    def __new__(cls, value):
-        if cls.functional_type is None:
-            raise NotImplementedError("Variables must have a functional data type such as 'distance', 'angle', 'bool', 'confidence'")
-        if cls.sql_data_type is None:
-            raise NotImplementedError("Variables must have an SQL data type such as INT")
-        if cls.header_name is None:
-            raise NotImplementedError("Variables must have a header name")
-        return  super(BaseIntVariable, cls).__new__(cls, value)
-
 
 class BaseBoolVariable(BaseIntVariable):
     """
@@ -103,8 +129,21 @@ class BaseRelativeVariable(BaseDistanceIntVar):
         :rtype: :class:`~ethoscope.core.variable.BaseRelativeVariable`
         """
         return self._get_absolute_value(roi)
+
+    def to_absolute_from_offset(self, offset):
+        """
+        Same as :meth:`to_absolute`, but using the offset of the ROI directly.
+        This is useful when converting many variables from the same ROI, as the offset is only queried once.
+
+        :param offset: the x,y offset of a region of interest (see :attr:`~ethoscope.core.roi.ROI.offset`)
+        :type offset: (int,int)
+        :return: A new variable
+        :rtype: :class:`~ethoscope.core.variable.BaseRelativeVariable`
+        """
+        raise NotImplementedError("Relative variable must implement a `to_absolute_from_offset()` method")
+
     def _get_absolute_value(self, roi):
-        raise NotImplementedError("Relative variable must implement a `get_absolute_value()` method")
+        return self.to_absolute_from_offset(roi.offset)
 
 
 class XPosVariable(BaseRelativeVariable):
@@ -112,22 +151,15 @@ class XPosVariable(BaseRelativeVariable):
     Type storing the X position of a detected object.
     """
     header_name = "x"
-    def _get_absolute_value(self, roi):
-        out = int(self)
-
-        ox, _ = roi.offset
-        out += ox
-        return XPosVariable(out)
+    def to_absolute_from_offset(self, offset):
+        return XPosVariable(self + offset[0])
 
 class YPosVariable(BaseRelativeVariable):
     """
     Type storing the Y position of a detected object.
     """
     header_name = "y"
-    def _get_absolute_value(self, roi):
-        out = int(self)
-        _, oy = roi.offset
-        out += oy
-        return YPosVariable(out)
+    def to_absolute_from_offset(self, offset):
+        return YPosVariable(self + offset[1])
 
 
@@ -0,0 +1,26 @@
+import unittest
+from ethoscope.core.variables import BaseIntVariable, BaseBoolVariable, BaseRelativeVariable, \
+    XPosVariable, YPosVariable, IsInferredVariable
+
+
+class TestVariables(unittest.TestCase):
+
+    def test_abstract_types_cannot_be_instantiated(self):
+        for cls in (BaseIntVariable, BaseBoolVariable, BaseRelativeVariable):
+            self.assertRaises(NotImplementedError, cls, 1)
+
+    def test_complete_types_are_ints(self):
+        x = XPosVariable(12)
+        self.assertIs(type(x), XPosVariable)
+        self.assertEqual(x, 12)
+        self.assertEqual(x.header_name, "x")
+        self.assertEqual(IsInferredVariable(True), 1)
+        self.assertIs(XPosVariable.__new__, int.__new__)
+
+    def test_to_absolute_from_offset(self):
+        x = XPosVariable(3).to_absolute_from_offset((10, 20))
+        y = YPosVariable(3).to_absolute_from_offset((10, 20))
+        self.assertIs(type(x), XPosVariable)
+        self.assertIs(type(y), YPosVariable)
+        self.assertEqual(x, 13)
+        self.assertEqual(y, 23)